@@ -104,6 +104,25 @@ class LEDDriver:
 
         self.__check_state(self, LEDStateMachineStates.Exit)
 
+    # Set the duty cycle directly (used by external controllers, e.g. closed-loop brightness control)
+    #   => duty_cycle: new duty cycle in per cent (clamped to 0..100)
+    def set_duty_cycle(self, duty_cycle):
+        duty_cycle = min(max(float(duty_cycle), 0.0), 100.0)
+
+        # Start PWM on first use
+        if self.gpio_control is None:
+            self.__start_hardware()
+            self.gpio_control = GPIO.PWM(self.pin_number, self.nominal_frequency)
+            self.gpio_control.start(duty_cycle)
+            self.state = LEDStateMachineStates.Dimming
+        elif duty_cycle == self.current_dc:
+            # Nothing changed, skip the (comparatively expensive) PWM update
+            return
+
+        self.previous_dc = self.current_dc
+        self.current_dc = duty_cycle
+        self.gpio_control.ChangeDutyCycle(duty_cycle)
+
     # Thread run function (private.. starts with __)
     def __thread_run(self):
         print("Dimming LED #" + str(self.pin_number))
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+########################################################################
+# Filename    : light_sensor_controller.py
+# Description : Closed-loop LED brightness control using the PCF8591 ADC
+#               (light sensors) and the LEDDriver PWM outputs.
+#               Can run against real hardware or a simulated ADC/light model.
+# Version     : 1.0
+# Author      : Luis Sousa
+# Modification: 2020/04/02
+########################################################################
+import numpy as np
+import time, sys
+
+
+# Reads the analog inputs of a PCF8591 ADC over I2C (see Docs/datasheet_PCF8591.pdf)
+class PCF8591:
+    DEFAULT_ADDRESS = 0x48  # I2C address with A0..A2 tied to GND
+    DEFAULT_BUS = 1  # I2C bus of the Raspberry PI (pins 3 and 5)
+    CONTROL_BYTE = 0x40  # Analog output enabled, single ended inputs, no auto-increment
+
+    # Constructor to initiate the ADC object
+    #   => channels: list of analog input channels (0..3) to be read
+    #   => address: I2C address of the PCF8591
+    #   => bus_number: I2C bus number
+    def __init__(self, channels, address=DEFAULT_ADDRESS, bus_number=DEFAULT_BUS):
+        import smbus  # only needed on the Raspberry PI
+
+        self.channels = list(channels)
+        self.address = address
+        self.bus = smbus.SMBus(bus_number)
+        self.samples = np.zeros(len(self.channels))
+
+    # Read all configured channels, returns an array with the raw 8 bit values (0..255)
+    def read_channels(self):
+        for index, channel in enumerate(self.channels):
+            self.bus.write_byte(self.address, self.CONTROL_BYTE | channel)
+            # First read returns the previous conversion result, the second one the requested channel
+            self.bus.read_byte(self.address)
+            self.samples[index] = self.bus.read_byte(self.address)
+        return self.samples
+
+
+# First order light model: every LED lights up its sensor with a time constant, plus ambient light
+class LightModel:
+    DEFAULT_TIME_CONSTANT = 0.05  # LED + sensor response time constant (s)
+    DEFAULT_GAIN = 2.0  # ADC counts per duty cycle per cent
+    DEFAULT_AMBIENT = 20.0  # Ambient light seen by the sensors (ADC counts)
+
+    # Constructor to initiate the light model
+    #   => num_channels: number of LED / sensor pairs
+    #   => time_constant: response time constant (s)
+    #   => gain: ADC counts per duty cycle per cent (scalar or one value per channel)
+    #   => ambient: ambient light in ADC counts (scalar or one value per channel)
+    def __init__(self,
+                 num_channels,
+                 time_constant=DEFAULT_TIME_CONSTANT,
+                 gain=DEFAULT_GAIN,
+                 ambient=DEFAULT_AMBIENT):
+        self.time_constant = time_constant
+        self.gain = np.broadcast_to(np.asarray(gain, dtype=float), (num_channels,)).copy()
+        self.ambient = np.broadcast_to(np.asarray(ambient, dtype=float), (num_channels,)).copy()
+        self.duty_cycles = np.zeros(num_channels)
+        self.brightness = self.ambient.copy()
+
+    # Advance the model by dt seconds
+    def step(self, dt):
+        target = self.ambient + self.gain * self.duty_cycles
+        alpha = min(dt / self.time_constant, 1.0)
+        self.brightness += alpha * (target - self.brightness)
+
+
+# Simulated LED: same set_duty_cycle interface as LEDDriver, feeds the light model
+class SimulatedLED:
+    def __init__(self, model, channel):
+        self.model = model
+        self.channel = channel
+        self.current_dc = 0.0
+
+    def set_duty_cycle(self, duty_cycle):
+        self.current_dc = min(max(float(duty_cycle), 0.0), 100.0)
+        self.model.duty_cycles[self.channel] = self.current_dc
+
+
+# Simulated PCF8591: samples the light model with noise and 8 bit quantization
+class SimulatedPCF8591:
+    DEFAULT_NOISE = 2.0  # Standard deviation of the sensor noise (ADC counts)
+
+    def __init__(self, model, noise=DEFAULT_NOISE, seed=None):
+        self.model = model
+        self.noise = noise
+        self.random = np.random.default_rng(seed)
+        self.last_read = None
+
+    def read_channels(self):
+        now = time.perf_counter()
+        if self.last_read is not None:
+            self.model.step(now - self.last_read)
+        self.last_read = now
+
+        samples = self.model.brightness + self.random.normal(0.0, self.noise, self.model.brightness.shape)
+        return np.clip(np.rint(samples), 0, 255)
+
+
+# Sliding window median (removes spikes) followed by an exponential low-pass filter, all channels at once
+class SampleFilter:
+    DEFAULT_WINDOW = 5  # Median window length (samples)
+    DEFAULT_ALPHA = 0.3  # Low-pass smoothing factor (1.0 = no smoothing)
+
+    def __init__(self, num_channels, window=DEFAULT_WINDOW, alpha=DEFAULT_ALPHA):
+        self.window = window
+        self.alpha = alpha
+        self.buffer = np.zeros((window, num_channels))
+        self.index = 0
+        self.count = 0
+        self.output = np.zeros(num_channels)
+
+    # Add a new set of samples (one per channel), returns the filtered values
+    def update(self, samples):
+        self.buffer[self.index] = samples
+        self.index = (self.index + 1) % self.window
+
+        if self.count < self.window:
+            # Window not full yet: initialize the low-pass with the first samples
+            self.count += 1
+            self.output[:] = np.median(self.buffer[:self.count], axis=0)
+        else:
+            median = np.median(self.buffer, axis=0)
+            self.output += self.alpha * (median - self.output)
+        return self.output
+
+
+# PID controller with feed-forward term and anti-windup, one instance controls all channels
+class BrightnessPID:
+    DEFAULT_KP = 0.2
+    DEFAULT_KI = 4.0
+    DEFAULT_KD = 0.0
+    MIN_DC = 0.0  # Min duty cycle (per cent)
+    MAX_DC = 100.0  # Max duty cycle (per cent)
+
+    # Constructor to initiate the controller
+    #   => num_channels: number of channels to control
+    #   => kp, ki, kd: PID gains (duty cycle per cent per ADC count)
+    #   => feed_forward: expected ADC counts per duty cycle per cent, 0 disables the feed-forward term
+    def __init__(self,
+                 num_channels,
+                 kp=DEFAULT_KP,
+                 ki=DEFAULT_KI,
+                 kd=DEFAULT_KD,
+                 feed_forward=0.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.feed_forward = feed_forward
+        self.integral = np.zeros(num_channels)
+        self.previous_error = np.zeros(num_channels)
+        self.output = np.zeros(num_channels)
+
+    # Calculate the new duty cycles
+    #   => setpoint: desired brightness (ADC counts, scalar or one value per channel)
+    #   => measurement: filtered brightness (ADC counts)
+    #   => dt: time since the last update (s)
+    def update(self, setpoint, measurement, dt):
+        error = setpoint - measurement
+        derivative = (error - self.previous_error) / dt if dt > 0 else 0.0
+        self.previous_error = error
+
+        base = setpoint / self.feed_forward if self.feed_forward > 0 else 0.0
+        integral = self.integral + error * dt
+        output = base + self.kp * error + self.ki * integral + self.kd * derivative
+
+        # Anti-windup: stop integrating on saturated channels, unless the error drives them back into range
+        integrate = ((output > self.MIN_DC) | (error > 0)) & ((output < self.MAX_DC) | (error < 0))
+        self.integral = np.where(integrate, integral, self.integral)
+
+        np.clip(output, self.MIN_DC, self.MAX_DC, out=self.output)
+        return self.output
+
+
+# Fixed-rate control loop: read ADC -> filter -> controller -> LED duty cycles
+class BrightnessController:
+    DEFAULT_RATE = 100  # Control loop frequency (Hz)
+    DEFAULT_TOLERANCE = 0.05  # Settling band, relative to the setpoint
+
+    # Constructor to initiate the control loop
+    #   => adc: object with read_channels() returning one sample per channel (PCF8591 or SimulatedPCF8591)
+    #   => leds: list of objects with set_duty_cycle() (LEDDriver or SimulatedLED), one per channel
+    #   => setpoint: desired brightness (ADC counts, scalar or one value per channel)
+    #   => rate: control loop frequency (Hz)
+    #   => sample_filter: SampleFilter instance (default filter if None)
+    #   => controller: BrightnessPID instance (default PID if None)
+    #   => tolerance: settling band relative to the setpoint
+    def __init__(self,
+                 adc,
+                 leds,
+                 setpoint,
+                 rate=DEFAULT_RATE,
+                 sample_filter=None,
+                 controller=None,
+                 tolerance=DEFAULT_TOLERANCE):
+        num_channels = len(leds)
+        self.adc = adc
+        self.leds = leds
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.tolerance = tolerance
+        self.sample_filter = sample_filter if sample_filter is not None else SampleFilter(num_channels)
+        self.controller = controller if controller is not None else BrightnessPID(num_channels)
+        self.applied_dc = np.full(num_channels, -1.0)
+        self.set_setpoint(setpoint)
+
+        # Statistics
+        self.cycles = 0
+        self.overruns = 0
+        self.busy_time = 0.0
+        self.start_time = None
+        self.stop_time = None
+
+    # Change the setpoint, restarts the settling time measurement
+    def set_setpoint(self, setpoint):
+        self.setpoint = np.broadcast_to(np.asarray(setpoint, dtype=float), self.applied_dc.shape).copy()
+        self.setpoint_time = time.perf_counter()
+        self.last_outside = np.full(self.setpoint.shape, self.setpoint_time)
+        self.last_sample_time = self.setpoint_time
+
+    # One control cycle, returns the filtered brightness
+    def step(self, now):
+        brightness = self.sample_filter.update(self.adc.read_channels())
+        duty_cycles = self.controller.update(self.setpoint, brightness, self.period)
+
+        # Only touch the LEDs whose duty cycle actually changed (rounded to the PWM resolution)
+        duty_cycles = np.round(duty_cycles, 1)
+        for channel in np.flatnonzero(duty_cycles != self.applied_dc):
+            self.leds[channel].set_duty_cycle(duty_cycles[channel])
+        self.applied_dc[:] = duty_cycles
+
+        # Settling time: remember the last time each channel was outside the tolerance band
+        outside = np.abs(self.setpoint - brightness) > self.tolerance * self.setpoint
+        self.last_outside[outside] = now
+        self.last_sample_time = now
+        return brightness
+
+    # Run the loop at a fixed rate
+    #   => duration: run time in seconds (None = until ctrl-c)
+    def run(self, duration=None):
+        print('Start brightness control: %d channels @ %dHz' % (len(self.leds), self.rate))
+        self.start_time = time.perf_counter()
+        self.set_setpoint(self.setpoint)
+        next_cycle = self.start_time
+        try:
+            while duration is None or next_cycle - self.start_time < duration:
+                now = time.perf_counter()
+                self.step(now)
+                self.cycles += 1
+                self.busy_time += time.perf_counter() - now
+
+                # Absolute deadlines avoid drift; skip cycles if we are running late
+                next_cycle += self.period
+                delay = next_cycle - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.overruns += 1
+                    next_cycle = time.perf_counter()
+        finally:
+            self.stop_time = time.perf_counter()
+
+    # Loop rate actually achieved (Hz)
+    def get_loop_rate(self):
+        elapsed = (self.stop_time or time.perf_counter()) - self.start_time
+        return self.cycles / elapsed if elapsed > 0 else 0.0
+
+    # Settling time per channel (s) since the last setpoint change, NaN if not settled
+    def get_settling_times(self):
+        settled = self.last_outside + self.period - self.setpoint_time
+        return np.where(self.last_outside < self.last_sample_time, settled, np.nan)
+
+    # Print the loop statistics
+    def get_data(self):
+        print("Brightness controller dump:")
+        print("\tChannels: %d, setpoint: %s" % (len(self.leds), str(self.setpoint)))
+        print("\tLoop rate: %.1fHz (nominal %dHz), cycles: %d, overruns: %d" %
+              (self.get_loop_rate(), self.rate, self.cycles, self.overruns))
+        if self.cycles > 0:
+            print("\tCompute time per cycle: %.1fus" % (1e6 * self.busy_time / self.cycles))
+        print("\tSettling time (s): " + str(np.round(self.get_settling_times(), 3)))
+        print("\tBrightness: " + str(np.round(self.sample_filter.output, 1)))
+        print("\tDuty cycles: " + str(self.applied_dc))
+
+
+# Build a controller against the simulated ADC and light model
+def create_simulation(num_channels, setpoint, rate):
+    # Spread the LED efficiency and ambient light a bit between channels
+    gain = np.linspace(1.5, 2.5, num_channels)
+    ambient = np.linspace(10.0, 40.0, num_channels)
+    model = LightModel(num_channels, gain=gain, ambient=ambient)
+    leds = [SimulatedLED(model, channel) for channel in range(num_channels)]
+    adc = SimulatedPCF8591(model)
+    controller = BrightnessPID(num_channels, feed_forward=LightModel.DEFAULT_GAIN)
+    return BrightnessController(adc, leds, setpoint, rate=rate, controller=controller)
+
+
+# Build a controller against the PCF8591 and the LED drivers
+def create_hardware(led_pins, sensor_channels, setpoint, rate):
+    import RPi.GPIO as GPIO
+    from led_pwm_driver_v2 import LEDDriver
+
+    GPIO.setmode(GPIO.BOARD)  # use PHYSICAL GPIO Numbering
+    leds = [LEDDriver(pin) for pin in led_pins]
+    adc = PCF8591(sensor_channels)
+    return BrightnessController(adc, leds, setpoint, rate=rate)
+
+
+if __name__ == '__main__':  # Program entrance
+    print('Program is starting...')
+    mode = 'sim'  # 'sim' or 'hw'
+    setpoint = 120.0  # Desired brightness (ADC counts)
+    duration = 5.0  # Run time (s)
+    num_channels = 16  # Simulated channels
+    rate = BrightnessController.DEFAULT_RATE
+
+    # Arguments: mode(sim|hw) setpoint(float) duration(float)
+    num_args = len(sys.argv)
+    if num_args > 4:
+        print('Error - too many arguments: mode(sim|hw) setpoint(float) duration(float)')
+    else:
+        if num_args >= 2:
+            mode = sys.argv[1]
+        if num_args >= 3:
+            try:
+                setpoint = float(sys.argv[2])
+            except ValueError:
+                print('Error setting the setpoint: argument is not a float')
+        if num_args == 4:
+            try:
+                duration = float(sys.argv[3])
+            except ValueError:
+                print('Error setting the duration: argument is not a float')
+
+    if mode == 'hw':
+        brightness_controller = create_hardware([11, 12, 13, 15], [0, 1, 2, 3], setpoint, rate)
+    else:
+        brightness_controller = create_simulation(num_channels, setpoint, rate)
+
+    try:
+        brightness_controller.run(duration)
+    except KeyboardInterrupt:   # Press ctrl-c to end the program.
+        pass
+    brightness_controller.get_data()
+
+    if mode == 'hw':
+        for led in brightness_controller.leds:
+            led.set_duty_cycle(0)
+        import RPi.GPIO as GPIO
+        GPIO.cleanup()